@@ -1,11 +1,16 @@
 import asyncio
 import argparse
+import collections
+import concurrent.futures
+import functools
 import logging
 import os
 import re
+import threading
 import time
 import unicodedata
 
+import cachetools
 import prometheus_client
 import slack
 
@@ -28,12 +33,42 @@ logger.setLevel(logging.DEBUG)
 
 
 bot_mention = '<@{}> '.format(os.environ['BOT_ID'])
-uuid_re = re.compile('.*([a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12}).*', re.I)
+uuid_re = re.compile('([a-f0-9]{8}-?[a-f0-9]{4}-?4[a-f0-9]{3}-?[89ab][a-f0-9]{3}-?[a-f0-9]{12})', re.I)
 
-recent_events = set()  # cache recent event timestamps
+recent_event_window = 600  # seconds to remember events, to ignore redeliveries after RTM reconnects
+recent_events = collections.deque()  # recent (channel, timestamp) event keys, oldest first
+recent_event_set = set()  # the same keys, for membership checks
 
 hydra_client = hydra.Client(username=os.environ['HYDRA_USER'], password=os.environ['HYDRA_PASSWORD'])
 dashboard_bases = [base for base in os.environ['DASHBOARDS'].split(' ') if base]
+case_pool = concurrent.futures.ThreadPoolExecutor(max_workers=8)  # for concurrent Hydra case lookups
+
+# short-lived caches so back-to-back commands on a cluster don't repeat the same lookups
+subscription_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+account_notes_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+entitlements_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+case_comments_cache = cachetools.TTLCache(maxsize=1024, ttl=60)
+
+
+@cachetools.cached(cache=subscription_cache, key=lambda cluster, labels: (cluster, frozenset(labels)))
+def get_subscription(cluster, labels):
+    return telemetry.subscription(cluster=cluster, labels=labels)
+
+
+@cachetools.cached(cache=account_notes_cache, key=lambda account: account)
+def get_account_notes(account):
+    return hydra_client.get_account_notes(account=account)
+
+
+@cachetools.cached(cache=entitlements_cache, key=lambda account: account)
+def get_entitlements(account):
+    return hydra_client.get_entitlements(account=account)
+
+
+# locked, because case_pool threads fill this cache concurrently
+@cachetools.cached(cache=case_comments_cache, key=lambda case: case, lock=threading.Lock())
+def get_case_comments(case):
+    return hydra_client.get_case_comments(case=case)
 
 
 class HelpRequest(ValueError):
@@ -76,6 +111,19 @@ async def _handle_message(msg_id, payload):
     if not original_text:
         return
 
+    timestamp = payload['data'].get('ts')
+    if timestamp:
+        # Slack timestamps are only unique within a channel
+        event_key = (payload['data'].get('channel'), timestamp)
+        cutoff = time.time() - recent_event_window
+        while recent_events and float(recent_events[0][1]) <= cutoff:
+            recent_event_set.discard(recent_events.popleft())
+        if event_key in recent_event_set:
+            logger.debug('msg id {}: skipping duplicate event {}'.format(msg_id, event_key))
+            return
+        recent_events.append(event_key)
+        recent_event_set.add(event_key)
+
     text = unicodedata.normalize("NFKD", original_text)
 
     handle_uuid_mention(text)
@@ -84,10 +132,10 @@ async def _handle_message(msg_id, payload):
 
     logger.debug("msg id {}: parsing '{}'".format(msg_id, text))
 
-    user_arg_line, body = (text.strip()+'\n').split('\n', 1)
-    user_args = user_arg_line.split()[1:]  # split and drop the '<@{bot-id}>' prefix
+    user_arg_line, _, body = text[len(bot_mention):].rstrip().partition('\n')
+    user_args = user_arg_line.split()
     try:
-        args = parser.parse_args(user_args)
+        args = parse_args(user_args)
     except HelpRequest as error:
         handler = handle_help(payload=payload, subparser=error.args[0]['parser'])
     except ValueError as error:
@@ -107,17 +155,41 @@ async def _handle_message(msg_id, payload):
             logger.error(response)
 
 
+def parse_args(user_args):
+    """Parse the common '{command} {cluster}' shape directly, falling back to argparse for help and errors.
+    """
+    if len(user_args) == 2 and not user_args[1].startswith('-'):
+        handler = command_handlers.get(user_args[0])
+        if handler:
+            return argparse.Namespace(cluster=user_args[1], func=handler)
+    elif user_args == ['help']:
+        return argparse.Namespace(func=handle_help)
+    return parser.parse_args(user_args)
+
+
 def handle_uuid_mention(text):
-    match = uuid_re.match(text)
+    # cheap checks before the regex: UUIDs are at least 32 characters and have a version-4 nibble
+    if len(text) < 32 or '4' not in text:
+        return
+    match = uuid_re.search(text)
     if match:
         uuid = match.groups()[0]
         mention_counter.labels(uuid).inc()
 
 
+def _reply(payload):
+    """Return a chat_postMessage bound to the payload's channel and thread.
+    """
+    data = payload['data']
+    return functools.partial(
+        payload['web_client'].chat_postMessage,
+        channel=data['channel'],
+        thread_ts=data.get('thread_ts', data['ts']),
+    )
+
+
 def handle_parse_args_error(payload, error):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     if len(error.args) == 1:
         details = error.args[0]
     else:
@@ -129,17 +201,15 @@ def handle_parse_args_error(payload, error):
         logger.error('parse_args error had no message: {}'.format(error))
         return
 
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, text=message)
+    return post(text=message)
 
 
 def handle_help(payload, args=None, body=None, subparser=None):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     if not subparser:
         subparser = parser
     message = subparser.format_help()
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, text=message)
+    return post(text=message)
 
 
 def _block_from_text(line):
@@ -165,82 +235,74 @@ def _summary_to_text(summary):
 
 
 def handle_summary(payload, args=None, body=None):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     cluster = args.cluster
-    blocks = []
     try:
         info, _,  _ = get_summary(cluster=cluster)
-        for line in info:
-            blocks.append(_block_from_text(line))
     except ValueError as error:
-        return web_client.chat_postMessage(
-            channel=channel,
-            thread_ts=thread,
-            text='{} {}'.format(cluster, error))
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, blocks=blocks)
+        return post(text='{} {}'.format(cluster, error))
+    return post(blocks=[_block_from_text(line) for line in info])
 
 
 def handle_detail(payload, args=None, body=None):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     cluster = args.cluster
-    blocks = []
     try:
         info, summary, notes = get_summary(cluster=cluster)
-        for line in info:
-            blocks.append(_block_from_text(line))
-        for line in summary:
-            blocks.append(_block_from_text(line))
-        if notes:
-            notes_text = _summary_to_text(notes)
-            blocks.append(_block_from_text(notes_text))
     except ValueError as error:
-        return web_client.chat_postMessage(
-            channel=channel,
-            thread_ts=thread,
-            text='{} {}'.format(cluster, error))
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, blocks=blocks)
+        return post(text='{} {}'.format(cluster, error))
+    blocks = [_block_from_text(line) for line in info + summary]
+    if notes:
+        blocks.append(_block_from_text(_summary_to_text(notes)))
+    return post(blocks=blocks)
 
 
-def get_notes(cluster, ebs_account):
-    notes = hydra_client.get_account_notes(account=ebs_account)
+def get_notes(cluster, ebs_account, related=True):
     summary = None
     subject_prefix = 'Summary (cluster {}): '.format(cluster)
     related_notes = []
-    for note in notes:
+    for note in get_account_notes(account=ebs_account):
         if note.get('isRetired'):
             continue
-        if not note['subject'].startswith(subject_prefix):
-            if cluster in note['subject']:
-                related_notes.append(note)
+        subject = note['subject']
+        if subject.startswith(subject_prefix):
+            if summary is None:
+                summary = note
+                if not related:
+                    break
             continue
-        summary = note
-        break
+        if related and cluster in subject:
+            related_notes.append(note)
     return summary, related_notes
 
 
 def get_entitlements_summary(ebs_account):
-    entitlements = hydra_client.get_entitlements(account=ebs_account)
+    entitlements = get_entitlements(account=ebs_account)
     if not entitlements:
         return 'None.  Customer Experience and Engagement (CEE) will not be able to open support cases.'
-    openshift_entitlements = ', '.join(sorted(set(
-        entitlement['supportLevel']
-        for entitlement in entitlements
-        if 'OpenShift' in entitlement['name']
-    ))) or 'None'
-    other_entitlements = ', '.join(sorted(set(
-        entitlement['supportLevel']
-        for entitlement in entitlements
-        if 'OpenShift' not in entitlement['name']
-    ))) or 'None'
+    openshift_levels, other_levels = set(), set()
+    for entitlement in entitlements:
+        levels = openshift_levels if 'OpenShift' in entitlement['name'] else other_levels
+        levels.add(entitlement['supportLevel'])
+    openshift_entitlements = ', '.join(sorted(openshift_levels)) or 'None'
+    other_entitlements = ', '.join(sorted(other_levels)) or 'None'
     return 'OpenShift: {}.  Other: {}'.format(openshift_entitlements, other_entitlements)
 
 
+def _mentions(value, text):
+    """Return True if text appears in any string within value's nested lists and dicts.
+    """
+    if isinstance(value, str):
+        return text in value
+    if isinstance(value, dict):
+        value = value.values()
+    elif not isinstance(value, list):
+        return False
+    return any(_mentions(item, text) for item in value)
+
+
 def get_summary(cluster):
-    subscription = telemetry.subscription(cluster=cluster, labels={'ebs_account', 'managed', 'support'})
+    subscription = get_subscription(cluster=cluster, labels={'ebs_account', 'managed', 'support'})
     ebs_account = telemetry.ebs_account(subscription=subscription)
     summary, related_notes = get_notes(cluster=cluster, ebs_account=ebs_account)
     lines = ['Cluster {}'.format(cluster)]
@@ -252,11 +314,11 @@ def get_summary(cluster):
     if not subscription.get('support'):
         lines.append('Entitlements: {}'.format(get_entitlements_summary(ebs_account=ebs_account)))
     lines.extend('Dashboard: {}{}'.format(dashboard_base, cluster) for dashboard_base in dashboard_bases)
-    cases = [
-        case
-        for case in hydra_client.get_open_cases(account=ebs_account)
-        if cluster in str(hydra_client.get_case_comments(case=case['caseNumber']))
-    ]
+    open_cases = hydra_client.get_open_cases(account=ebs_account)
+    case_mentions = case_pool.map(
+        lambda case: _mentions(get_case_comments(case=case['caseNumber']), cluster),
+        open_cases)
+    cases = [case for case, mentioned in zip(open_cases, case_mentions) if mentioned]
     lines.extend('Case {caseNumber} ({createdDate}, {caseOwner[name]}): {subject}'.format(**case) for case in cases)
     existing_summary = []
     if summary:
@@ -268,9 +330,7 @@ def get_summary(cluster):
 
 
 def handle_set_summary(payload, args=None, body=None):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     cluster = args.cluster
     try:
         subject, body = body.split('\n', 1)
@@ -279,47 +339,42 @@ def handle_set_summary(payload, args=None, body=None):
     body = (body.strip() + '\n\nThis summary was created by the cluster-support bot.  Workflow docs in https://github.com/openshift/cluster-support-bot/').strip()
     subject_prefix = 'Summary (cluster {}): '.format(cluster)
     try:
-        ebs_account = telemetry.ebs_account(subscription=telemetry.subscription(cluster=cluster, labels={'ebs_account'}))
-        summary, _ = get_notes(cluster=cluster, ebs_account=ebs_account)
+        ebs_account = telemetry.ebs_account(subscription=get_subscription(cluster=cluster, labels={'ebs_account'}))
+        account_notes_cache.pop(ebs_account, None)  # find the current summary, not a cached one
+        summary, _ = get_notes(cluster=cluster, ebs_account=ebs_account, related=False)
         hydra_client.post_account_note(
             account=ebs_account,
             subject='{}{}'.format(subject_prefix, subject),
             body=body,
         )
+        account_notes_cache.pop(ebs_account, None)
         if summary:
             hydra_client.delete_account_note(account=ebs_account, noteID=summary['id'])
         comment_counter.labels(cluster).inc()
     except ValueError as error:
-        return web_client.chat_postMessage(
-            channel=channel,
-            thread_ts=thread,
-            text='{} {}'.format(cluster, error))
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, text='set {} summary to:\n{}\n{}'.format(cluster, subject, body))
+        return post(text='{} {}'.format(cluster, error))
+    return post(text='set {} summary to:\n{}\n{}'.format(cluster, subject, body))
 
 
 def handle_comment(payload, args=None, body=None):
-    web_client = payload['web_client']
-    channel = payload['data']['channel']
-    thread = payload['data'].get('thread_ts', payload['data']['ts'])
+    post = _reply(payload)
     cluster = args.cluster
     try:
         subject, body = body.split('\n', 1)
     except ValueError:  # subject with no body
         subject, body = body, ''
     try:
-        ebs_account = telemetry.ebs_account(subscription=telemetry.subscription(cluster=cluster, labels={'ebs_account'}))
+        ebs_account = telemetry.ebs_account(subscription=get_subscription(cluster=cluster, labels={'ebs_account'}))
         hydra_client.post_account_note(
             account=ebs_account,
             subject='cluster {}: {}'.format(cluster, subject),
             body=body,
         )
+        account_notes_cache.pop(ebs_account, None)
         comment_counter.labels(cluster).inc()
     except ValueError as error:
-        return web_client.chat_postMessage(
-            channel=channel,
-            thread_ts=thread,
-            text='{} {}'.format(cluster, error))
-    return web_client.chat_postMessage(channel=channel, thread_ts=thread, text='added comment on {}:\n{}\n{}'.format(cluster, subject, body))
+        return post(text='{} {}'.format(cluster, error))
+    return post(text='added comment on {}:\n{}\n{}'.format(cluster, subject, body))
 
 
 parser = ErrorRaisingArgumentParser(
@@ -343,6 +398,8 @@ comment_parser = subparsers.add_parser('comment', help='Add a comment on a clust
 comment_parser.add_argument('cluster', metavar='ID', help='The cluster ID.')
 comment_parser.set_defaults(func=handle_comment)
 
+command_handlers = {name: sub.get_default('func') for name, sub in subparsers.choices.items() if name != 'help'}
+
 # start the RTM socket
 rtm_client = slack.RTMClient(token=os.environ['SLACK_BOT_TOKEN'])
 logger.info("bot starting...")